@@ -1,17 +1,111 @@
 #!/usr/bin/env python3
 
+import codecs
+import concurrent.futures
+import ctypes
+import mmap
 import os
-from typing import Callable
-from zipfile import ZipFile
+import queue
+import re
+import struct
+import threading
+import zlib
+from typing import Callable, Iterable, NamedTuple
+from zipfile import ZIP_STORED, BadZipFile, ZipFile, ZipInfo
 
-import chardet
 from entrypoint2 import entrypoint
 from rarfile import RarFile
 
+try:
+    from cchardet import UniversalDetector
+    from cchardet import detect as _chardet_detect
+except ImportError:
+    from charset_normalizer import detect as _chardet_detect
+    UniversalDetector = None
+
+try:
+    from unrar import constants as unrar_constants
+    from unrar import unrarlib
+except (ImportError, LookupError):  # python-unrar isn't installed or can't find libunrar
+    unrarlib = None
+
 CHUNKSIZE = 30 * (1024**2)  # read/write in (up to) 30MiB chunks
+MMAP_THRESHOLD = 64 * (1024**2)  # write unconverted files bigger than 64MiB through mmap
+DETECT_SAMPLESIZE = 4 * 1024  # only look at the first 4KiB when guessing encodings
+# (prefixes of) codec names where ascii bytes don't necessarily mean ascii characters
+ASCII_INCOMPATIBLE = ('utf-16', 'utf-32', 'utf-7', 'iso2022', 'hz')
+
+
+def _codec_name(enc: str):
+    '''normalise a detected encoding name to python's codec name, or None if it isn't known'''
+    try:
+        return codecs.lookup(enc).name if enc else None
+    except LookupError:  # detector came up with something python doesn't know about
+        return None
+
+
+def _sample(buf: bytes) -> (bytes, bool):
+    '''about the first DETECT_SAMPLESIZE bytes of buf, cut after a newline or failing that an ascii byte, and whether
+    it could end in half a character. detectors (charset-normalizer especially) guess wildly wrong if it does'''
+    if len(buf) <= DETECT_SAMPLESIZE:
+        return bytes(buf), False
+    sample = bytes(buf[:DETECT_SAMPLESIZE])
+    end = sample.rfind(b'\n') + 1
+    if end and buf[end:end + 1] == b'\x00':  # utf-16-le newline
+        end += 1
+    if end < DETECT_SAMPLESIZE // 2:
+        last_ascii = re.search(rb'[\x00-\x7f][\x80-\xff]*\Z', sample)
+        end = last_ascii.start() + 1 if last_ascii else 0
+    if end < DETECT_SAMPLESIZE // 2:  # nothing sensible to cut at, take it as it is
+        return sample, True
+    return sample[:end], False
+
+
+def _detect(buf: bytes) -> {}:
+    '''guess the encoding of buf, returning a dict with the python codec name or None as 'encoding' '''
+    sample, uncut = _sample(buf)
+    if not uncut:
+        return {'encoding': _codec_name(_chardet_detect(sample).get('encoding'))}
+    guess = None
+    # the sample can end in half a character. a guess that can't even decode it is wrong,
+    # so try again with the last few bytes cut off
+    for cut in range(4):
+        enc = _codec_name(_chardet_detect(sample[:len(sample) - cut]).get('encoding'))
+        if enc is None:
+            continue
+        guess = guess or enc
+        try:
+            sample[:len(sample) - cut].decode(enc)
+            return {'encoding': enc}
+        except UnicodeDecodeError:
+            pass
+    return {'encoding': guess}
+
+
+def _detect_iter(bufs: Iterable[bytes]) -> {}:
+    '''like _detect, but for input that comes in pieces. stops consuming bufs as soon as there's enough to go on'''
+    if UniversalDetector is None:
+        sample = bytearray()
+        for buf in bufs:
+            if sample and len(sample) + len(buf) > DETECT_SAMPLESIZE:
+                break  # only whole names, so _detect doesn't have to cut one in half
+            sample += buf
+        return _detect(sample)
+
+    det = UniversalDetector()
+    fed = 0
+    for buf in bufs:
+        det.feed(buf)
+        fed += len(buf)
+        if det.done or fed >= DETECT_SAMPLESIZE:
+            break
+    det.close()
+    return {'encoding': _codec_name(det.result.get('encoding'))}
 
 
-def safepath(path: str, is_file=False):
+def safepath(path: str, is_file=False, create_dir=False):
+    '''find a variation of path that doesn't exist yet. with create_dir, also create it as a directory right away,
+    so concurrent callers can't end up with the same path'''
     path = path.rstrip('/')
     nr = 1
     if is_file:
@@ -28,11 +122,125 @@ def safepath(path: str, is_file=False):
     while True:
         new = makepath(path)
         if not os.path.exists(new):
-            break
+            if not create_dir:
+                break
+            try:
+                os.makedirs(new)
+                break
+            except FileExistsError:  # someone else got there first
+                pass
         nr += 1
     return new
 
 
+def chunksize_for(file_size: int) -> int:
+    '''chunk size for copying a file of file_size bytes without converting it: ~1/16th of the file, 1MiB to 64MiB'''
+    return min(max(file_size // 16, 1024**2), 64 * 1024**2)
+
+
+def write_all(out, data: bytes):
+    '''write all of data to out. output files are unbuffered, and raw writes may write less than asked for'''
+    view = memoryview(data)
+    while len(view):
+        view = view[out.write(view):]
+
+
+def _writev_all(fd: int, bufs: []):
+    '''write all of bufs to fd with as few writev() calls as possible'''
+    bufs = [memoryview(b) for b in bufs]
+    while bufs:
+        written = os.writev(fd, bufs)
+        while bufs and written >= len(bufs[0]):
+            written -= len(bufs.pop(0))
+        if bufs:
+            bufs[0] = bufs[0][written:]
+
+
+def copy_chunks(src, out, size: int, write_hook: Callable[[bytes], bytes] = None, chunk_size: int = CHUNKSIZE):
+    '''copy size bytes from src to out in chunk_size chunks, reading (decompressing) the next chunk in a separate thread
+    while the current one is being written. out needs to be unbuffered'''
+    chunk_size = min(chunk_size, size)
+    if size <= chunk_size:  # a single chunk, nothing to overlap
+        while True:
+            chunk = src.read(chunk_size)
+            if not chunk:
+                return
+            write_all(out, write_hook(chunk) if write_hook else chunk)
+
+    chunks = queue.Queue(maxsize=2)
+    stop = threading.Event()
+
+    def reader():
+        try:
+            while not stop.is_set():
+                # not readinto(): rarfile only checks CRCs and unrar's exit code in read(),
+                # and ZipExtFile.readinto is just read() and a copy
+                chunk = src.read(chunk_size)
+                chunks.put(chunk)
+                if not chunk:
+                    break
+        except BaseException as e:
+            chunks.put(e)
+
+    def get(block=True):
+        chunk = chunks.get(block)
+        if isinstance(chunk, BaseException):
+            raise chunk
+        return chunk
+
+    t = threading.Thread(target=reader, daemon=True)
+    t.start()
+    try:
+        done = False
+        while not done:
+            chunk = get()
+            if not chunk:
+                break
+            batch = [chunk]
+            # if the reader is already a chunk ahead, write both with a single syscall
+            if write_hook is None and hasattr(os, 'writev'):
+                try:
+                    ahead = get(block=False)
+                    if ahead:
+                        batch.append(ahead)
+                    else:
+                        done = True
+                except queue.Empty:
+                    pass
+            if write_hook:
+                write_all(out, write_hook(chunk))
+            elif len(batch) == 1:
+                write_all(out, chunk)
+            else:
+                _writev_all(out.fileno(), batch)
+    finally:
+        # make sure the reader is gone before src gets closed
+        stop.set()
+        while t.is_alive():
+            try:
+                chunks.get_nowait()
+            except queue.Empty:
+                t.join(0.1)
+
+
+def copy_mmap(src, out, size: int):
+    '''copy size bytes from src to out through an mmap of out. out needs to be opened for reading too.
+    src is read() rather than readinto()'d, rarfile only checks CRCs and unrar's exit code in read()'''
+    os.ftruncate(out.fileno(), size)
+    flags = {'flags': mmap.MAP_SHARED | mmap.MAP_POPULATE} if hasattr(mmap, 'MAP_POPULATE') else {}
+    chunk_size = chunksize_for(size)
+    off = 0
+    with mmap.mmap(out.fileno(), size, **flags) as mm, memoryview(mm) as view:
+        while off < size:
+            chunk = src.read(min(chunk_size, size - off))
+            if not chunk:
+                break
+            view[off:off + len(chunk)] = chunk
+            off += len(chunk)
+    if off < size:  # member ended early, don't leave zeroes at the end
+        os.ftruncate(out.fileno(), off)
+
+
 class Extractor(object):
     def __init__(self, archive_path: str):
         raise NotImplementedError()
@@ -46,10 +254,14 @@ class Extractor(object):
     def list_files(self) -> {}:
         raise NotImplementedError()
 
+    def file_size(self, file_name: str) -> int:
+        raise NotImplementedError()
+
     def extract(self,
                 file_name: str,
                 dest_path: str,
-                write_hook: Callable[[bytes], bytes] = None):
+                write_hook: Callable[[bytes], bytes] = None,
+                flush_hook: Callable[[], bytes] = None):
         raise NotImplementedError()
 
 
@@ -57,24 +269,125 @@ class RarFileExtractor(Extractor):
     def __init__(self, archive_path: str):
         self.archive_path = archive_path
         self.rarfile = RarFile(self.archive_path)
-        self.namelist = {i.filename for i in self.rarfile.infolist() if not i.isdir()}
+        infolist = self.rarfile.infolist()
+        self._infomap = {i.filename: i for i in infolist if not i.isdir()}
+        self.namelist = self._infomap.keys()  # in archive order, so libunrar can go through it in a single pass
+
+        # libunrar state. members are found by their position in the archive, since libunrar and rarfile
+        # don't necessarily decode non-unicode names the same way
+        self._use_unrarlib = unrarlib is not None
+        self._positions = {i.filename: n for n, i in enumerate(infolist)}
+        self._unrar = None  # archive handle
+        self._unrar_archive = None
+        self._unrar_pos = 0  # position of the header the handle is at
+        self._unrar_sink = None  # (out, write_hook) of the member being extracted
+        self._unrar_errors = []
+        if self._use_unrarlib:
+            self._unrar_callback = unrarlib.UNRARCALLBACK(self._on_unrar_message)
 
     def __exit__(self, *args):
+        self._unrar_close()
         self.rarfile.close()
 
     def list_files(self) -> {}:
         return self.namelist
 
+    def file_size(self, file_name: str) -> int:
+        return self._infomap[file_name].file_size
+
     def extract(self,
                 file_name: str,
                 dest_path: str,
-                write_hook: Callable[[bytes], bytes] = None):
-        with self.rarfile.open(file_name) as rf, open(dest_path, 'wb') as out:
+                write_hook: Callable[[bytes], bytes] = None,
+                flush_hook: Callable[[], bytes] = None):
+        info = self._infomap[file_name]
+        # links and file copies only reference another member, libunrar can't test-extract those into a callback
+        if self._use_unrarlib and not info.file_redir:
+            if self._unrar_seek(info):
+                with open(dest_path, 'w+b', buffering=0) as out:
+                    self._unrar_extract(out, write_hook)
+                    if flush_hook:
+                        write_all(out, flush_hook())
+                return
+            self._use_unrarlib = False  # libunrar doesn't see the archive the way rarfile does, leave it to rarfile
+        chunk_size = CHUNKSIZE if write_hook else chunksize_for(info.file_size)
+        with self.rarfile.open(info) as rf, open(dest_path, 'w+b', buffering=0) as out:
+            if write_hook is None and info.file_size > MMAP_THRESHOLD:
+                copy_mmap(rf, out, info.file_size)
+            else:
+                copy_chunks(rf, out, info.file_size, write_hook, chunk_size)
+            if flush_hook:
+                write_all(out, flush_hook())
+
+    def _on_unrar_message(self, msg, user_data, p1, p2):
+        '''libunrar callback, gets handed the decompressed data of the member being extracted'''
+        if msg == unrar_constants.UCM_PROCESSDATA:
+            try:
+                out, write_hook = self._unrar_sink
+                chunk = ctypes.string_at(p1, p2)
+                write_all(out, write_hook(chunk) if write_hook else chunk)
+            except BaseException as e:  # can't raise through C, stash it and make libunrar stop
+                self._unrar_errors.append(e)
+                return -1
+            return 1
+        if msg in (unrar_constants.UCM_CHANGEVOLUME, unrar_constants.UCM_CHANGEVOLUMEW):
+            return 1 if p2 == unrar_constants.RAR_VOL_NOTIFY else -1  # next volume is missing
+        return -1  # needs a password
+
+    def _unrar_close(self):
+        if self._unrar is not None:
+            handle, self._unrar, self._unrar_archive = self._unrar, None, None
+            unrarlib.RARCloseArchive(handle)
+
+    def _unrar_seek(self, info) -> bool:
+        '''move the libunrar handle to info's header, (re)opening the archive if needed.
+        returns False if libunrar can't get there, or the member it finds there doesn't look like info'''
+        index = self._positions[info.filename]
+        if self._unrar is not None and self._unrar_pos > index:
+            self._unrar_close()
+        try:
+            if self._unrar is None:
+                archive = unrarlib.RAROpenArchiveDataEx(self.archive_path, mode=unrar_constants.RAR_OM_EXTRACT)
+                self._unrar = unrarlib.RAROpenArchiveEx(ctypes.byref(archive))
+                self._unrar_archive = archive
+                self._unrar_pos = 0
+            unrarlib.RARSetCallback(self._unrar, self._unrar_callback, 0)
+            header = unrarlib.RARHeaderDataEx()
             while True:
-                chunk = rf.read(CHUNKSIZE)
-                if not chunk:
+                unrarlib.RARReadHeaderEx(self._unrar, ctypes.byref(header))
+                if self._unrar_pos == index:
                     break
-                out.write(write_hook(chunk) if write_hook else chunk)
+                unrarlib.RARProcessFileW(self._unrar, unrar_constants.RAR_SKIP, None, None)
+                self._unrar_pos += 1
+        except unrarlib.UnrarException:  # also covers ArchiveEnd, and libunrar not being able to open the archive
+            self._unrar_close()
+            return False
+        except BaseException:
+            self._unrar_close()
+            raise
+        if header.UnpSize + (header.UnpSizeHigh << 32) != info.file_size:
+            self._unrar_close()  # the handle is stuck before an unprocessed header now
+            return False
+        return True
+
+    def _unrar_extract(self, out, write_hook: Callable[[bytes], bytes] = None):
+        '''extract the member the handle is at to out. libunrar hands us the decompressed data through a callback,
+        instead of having rarfile pipe it out of an unrar process'''
+        self._unrar_sink = (out, write_hook)
+        self._unrar_errors = []
+        try:
+            unrarlib.RARProcessFileW(self._unrar, unrar_constants.RAR_TEST, None, None)
+            self._unrar_pos += 1
+        except BaseException:
+            self._unrar_close()
+            if self._unrar_errors:
+                raise self._unrar_errors[0]
+            raise
+        finally:
+            self._unrar_sink = None
+        if self._unrar_errors:
+            self._unrar_close()
+            raise self._unrar_errors[0]
 
 
 class ZipFileExtractor(Extractor):
@@ -82,19 +395,23 @@ class ZipFileExtractor(Extractor):
         self.archive_path = archive_path
         self.zipfile = ZipFile(self.archive_path, 'r')
 
+        self._infomap = {}  # (converted) filename -> ZipInfo
+        raw_names = {}  # cp437-encoded (i.e. original) bytes -> ZipInfo, for filenames that aren't utf8
+        for f in self.zipfile.filelist:
+            if f.filename.endswith('/'):  # filter out directories
+                continue
+            if f.flag_bits & 0x800:
+                self._infomap[f.filename] = f
+            else:
+                raw_names[f.filename.encode('cp437', 'ignore')] = f
+
         # encoding for filenames that aren't utf8
-        # if chardet can't come up with anything, we assume it's shift_jis
+        # if the detector can't come up with anything, we assume it's shift_jis
         # TODO: this can fail for archives with few files/files with short names inside
-        names_concat = b''.join([n.encode('cp437', 'ignore') for n in self.zipfile.namelist()])
-        self.filename_encoding = chardet.detect(names_concat).get('encoding') or 'shift_jis'
-
-        # maintain a mapping of converted filenames -> original borked names
-        self.orig_names = {f.filename.encode('cp437', 'ignore').decode(self.filename_encoding, 'ignore'): f.filename
-                           for f in self.zipfile.filelist 
-                           if f.flag_bits & 0x800 == 0}
+        self.filename_encoding = _detect_iter(raw_names).get('encoding') or 'shift_jis'
 
-        self.namelist = {f.filename for f in self.zipfile.filelist if f.flag_bits & 0x800 != 0} | set(self.orig_names.keys())
-        self.namelist = {n for n in self.namelist if not n.endswith('/')}  # filter out directories
+        self._infomap.update((raw.decode(self.filename_encoding, 'ignore'), f) for raw, f in raw_names.items())
+        self.namelist = set(self._infomap)
 
     def __exit__(self, *args):
         self.zipfile.close()
@@ -102,19 +419,72 @@ class ZipFileExtractor(Extractor):
     def list_files(self) -> {}:
         return self.namelist
 
+    def file_size(self, file_name: str) -> int:
+        return self._infomap[file_name].file_size
+
     def extract(self,
                 file_name: str,
                 dest_path: str,
-                write_hook: Callable[[bytes], bytes] = None):
-        with self.zipfile.open(self.orig_names.get(file_name, file_name), 'r') as zf, open(dest_path, 'wb') as out:
-            while True:
-                chunk = zf.read(CHUNKSIZE)
-                if not chunk:
-                    break
-                out.write(write_hook(chunk) if write_hook else chunk)
+                write_hook: Callable[[bytes], bytes] = None,
+                flush_hook: Callable[[], bytes] = None):
+        info = self._infomap[file_name]
+        if info.compress_type == ZIP_STORED and write_hook is None and flush_hook is None:
+            with open(dest_path, 'w+b', buffering=0) as out:
+                if self._sendfile_stored(info, out):
+                    return
+        chunk_size = CHUNKSIZE if write_hook else chunksize_for(info.file_size)
+        with self.zipfile.open(info, 'r') as zf, open(dest_path, 'w+b', buffering=0) as out:
+            if write_hook is None and info.file_size > MMAP_THRESHOLD:
+                copy_mmap(zf, out, info.file_size)
+            else:
+                copy_chunks(zf, out, info.file_size, write_hook, chunk_size)
+            if flush_hook:
+                write_all(out, flush_hook())
+
+    def _sendfile_stored(self, info: ZipInfo, out) -> bool:
+        '''copy an uncompressed member straight from the archive to out, without going through userspace.
+        returns False if that isn't possible, in which case out is left empty. out needs to be opened for reading too'''
+        if info.flag_bits & 0x1:  # encrypted
+            return False
+        try:
+            zip_fd = self.zipfile.fp.fileno()
+            # local file header: signature, ..., filename length and extra field length at offset 26
+            header = os.pread(zip_fd, 30, info.header_offset)
+            if len(header) != 30 or header[:4] != b'PK\x03\x04':
+                return False
+            name_len, extra_len = struct.unpack('<HH', header[26:30])
+            offset = info.header_offset + 30 + name_len + extra_len
+            remaining = info.file_size
+            while remaining > 0:
+                sent = os.sendfile(out.fileno(), zip_fd, offset, remaining)
+                if sent == 0:
+                    raise EOFError('archive ended before member did')
+                offset += sent
+                remaining -= sent
+        except (AttributeError, OSError, EOFError, ValueError):
+            # no pread/sendfile on this platform/file, or the archive is broken; leave it to zipfile
+            out.seek(0)
+            out.truncate()
+            return False
+
+        # zipfile would check the CRC while reading, so do it here. what we just wrote is still in the page cache
+        crc = 0
+        offset = 0
+        chunk_size = chunksize_for(info.file_size)
+        while offset < info.file_size:
+            chunk = os.pread(out.fileno(), chunk_size, offset)
+            if not chunk:
+                break
+            crc = zlib.crc32(chunk, crc)
+            offset += len(chunk)
+        if crc != info.CRC:
+            raise BadZipFile(f'Bad CRC-32 for file {info.filename!r}')
+        return True
 
 
 def truncate_utf8(string: str, max_len: int) -> str:
+    if len(string) * 4 <= max_len:  # can't be too long, even if every char takes up 4 bytes
+        return string
     utf8 = string.encode('utf-8')
     if len(utf8) <= max_len:
         return string
@@ -128,16 +498,152 @@ def truncate_utf8_filename(path: str, max_len: int) -> str:
 class DejizzFilter(object):
     def __init__(self, encode: str = 'utf-8', decode_default: str = 'shift_jis'):
         self.detected_encoding = None
-        self.encode = encode
-        self.decode_default = decode_default.lower()
+        self.encode = codecs.lookup(encode).name
+        self.decode_default = codecs.lookup(decode_default).name
+        self._dec = None
+        self._enc = codecs.getincrementalencoder(self.encode)()
+        self._encode_chunk = self._enc.encode
+        self._decode_chunk = None
+        self._passthrough = False
+        self._ascii_passthrough = False
+
+    def _init_decoder(self, chunk: bytes):
+        self.detected_encoding = _detect(chunk).get('encoding') or self.decode_default
+        # keep decoder state between chunks, so characters split across chunk boundaries don't get lost
+        self._dec = codecs.getincrementaldecoder(self.detected_encoding)(errors='replace')
+        self._decode_chunk = self._dec.decode
+        self._passthrough = (self.detected_encoding == self.encode
+                             or self.detected_encoding == 'ascii' and self.encode == 'utf-8')
+        # pure ascii chunks come out the same if both encodings agree with ascii
+        self._ascii_passthrough = not (self.detected_encoding.startswith(ASCII_INCOMPATIBLE)
+                                       or self.encode.startswith(ASCII_INCOMPATIBLE))
+
+    def _transcode(self, chunk: bytes) -> bytes:
+        # call the codec's bound methods directly instead of going through the codec registry for every chunk
+        return self._encode_chunk(self._decode_chunk(chunk))
 
     def dejizz(self, chunk: bytes):
         if self.detected_encoding is None:
-            det = chardet.detect(chunk[:2048])
-            self.detected_encoding = (det.get('encoding', None) or self.decode_default).lower()
-        if self.detected_encoding == self.encode:
+            self._init_decoder(chunk)
+        if self._passthrough:
+            return chunk
+        if self._ascii_passthrough and chunk.isascii() and not self._dec.getstate()[0]:
             return chunk
-        return chunk.decode(self.detected_encoding, 'ignore').encode(self.encode)
+        return self._transcode(chunk)
+
+    def flush(self):
+        '''return whatever is left in the decoder/encoder buffers after the last chunk'''
+        if self._dec is None or self._passthrough:
+            return b''
+        return self._enc.encode(self._dec.decode(b'', final=True), final=True)
+
+
+def _create_excl(path: str) -> bool:
+    '''create path as an empty file, unless it already exists'''
+    try:
+        open(path, 'xb').close()
+        return True
+    except FileExistsError:
+        return False
+
+
+def _single_root(names: Iterable[str]) -> bool:
+    '''check whether all names share the same top-level file or dir, stopping at the first one that doesn't'''
+    # TODO: handle backslashes?
+    it = iter(names)
+    first = next(it).split('/', 1)[0]
+    return all(n.split('/', 1)[0] == first for n in it)
+
+
+EXTRACTORS = {
+    '.zip': ZipFileExtractor,
+    '.rar': RarFileExtractor
+}
+
+
+class ExtractOptions(NamedTuple):
+    dejizz_ext: frozenset
+    no_dejizz: bool
+    delete_archives: bool
+    verbose: bool
+    conflict: str
+    filename_length: int
+
+
+def _extract_one(root: str, name: str, options: ExtractOptions):
+    '''extract a single archive (name) in root'''
+    archive_path = os.path.join(root, name)
+    splitext = os.path.splitext(name)
+    ext = splitext[1].lower()
+    with EXTRACTORS[ext](archive_path) as extractor:
+        fl = extractor.list_files()
+        if len(fl) == 0:  # empty (possibly corrupt) archive
+            return
+        single_root = _single_root(fl)  # archive has a single top-level file or dir
+
+        extract_root = root if single_root else safepath(os.path.join(root, splitext[0]), create_dir=True)
+        created_dirs = set()
+
+        for f in fl:
+            dest = os.path.join(
+                extract_root,
+                truncate_utf8_filename(f, int(options.filename_length)) if options.filename_length else f
+            )
+
+            if options.verbose:
+                print(f'extracting {archive_path}:{f} -> {dest}')
+
+            dest_dir = os.path.split(dest)[0]
+            if dest_dir and dest_dir not in created_dirs:
+                os.makedirs(dest_dir, exist_ok=True)
+                created_dirs.add(dest_dir)
+
+            # claim dest by creating it exclusively, other workers may be extracting to the same place
+            choice = None
+            if not _create_excl(dest):
+                choice = options.conflict
+                if choice is None:
+                    print(f'{dest} already exists.')
+                while choice not in ['o', 'r', 's']:
+                    choice = input('[S]kip, [o]verwrite, or [r]ename: ')
+                    if not choice:
+                        choice = 's'
+                if choice == 's':
+                    continue
+                elif choice == 'r':
+                    dest = safepath(dest)
+                    while not _create_excl(dest):
+                        dest = safepath(dest)
+
+            if extractor.file_size(f) == 0:  # nothing to extract or convert
+                open(dest, 'wb').close()
+                continue
+
+            out_path = dest
+            if choice == 'o':
+                # someone else might be writing dest right now, so write next to it and swap it in when done
+                out_path = os.path.join(dest_dir, f'.ej-{os.getpid()}.part')
+
+            dj = not options.no_dejizz and os.path.splitext(f)[1].lower() in options.dejizz_ext
+            if dj:
+                djfilter = DejizzFilter()
+            try:
+                extractor.extract(f, out_path,
+                                  write_hook=djfilter.dejizz if dj else None,
+                                  flush_hook=djfilter.flush if dj else None)
+                if out_path != dest:
+                    os.replace(out_path, dest)
+            except BaseException:
+                if out_path != dest:
+                    os.unlink(out_path)
+                raise
+            if dj and options.verbose and djfilter.detected_encoding != 'utf-8':
+                print(f'converted from {djfilter.detected_encoding} to UTF-8: {f}')
+
+        if options.delete_archives:
+            if options.verbose:
+                print(f'deleting {archive_path}')
+            os.unlink(archive_path)
 
 
 @entrypoint
@@ -150,7 +656,7 @@ def main(source,
          overwrite=False,
          rename=False,
          filename_length=None):
-    """Extract ZIP and RAR archives inside a directory recursively while trying to convert ZIP filenames to UTF-8 (using chardetect).
+    """Extract ZIP and RAR archives inside a directory recursively while trying to convert ZIP filenames to UTF-8 (using charset-normalizer or cchardet).
 
     source: Directory containing archives to be extracted (or a single archive file)
     dejizz_ext: File extensions to try to convert to UTF-8, case insensitive
@@ -163,12 +669,7 @@ def main(source,
     filename_length: max. length in bytes an extracted file's name (*not* path) should be truncated to (assumes utf-8)
     """
 
-    extractors = {
-        '.zip': ZipFileExtractor,
-        '.rar': RarFileExtractor
-    }
-
-    dejizz_ext = {'.'+spl for spl in dejizz_ext.split(',')}
+    dejizz_ext = frozenset('.' + spl.strip().lower() for spl in dejizz_ext.split(','))
 
     def filelist(path):
         if os.path.isfile(path):
@@ -182,62 +683,18 @@ def main(source,
     if rename: conflict = 'r'
     if skip: conflict = 's'
 
-    files = filelist(source)
-    for root, name in files:
-        splitext = os.path.splitext(name)
-        ext = splitext[1].lower()
-        if ext not in extractors:
-            continue
-        with extractors[ext](os.path.join(root, name)) as extractor:
-            single_root = False  # archive has a single top-level file or dir
-            fl = extractor.list_files()
-            if len(fl) == 0:  # empty (possibly corrupt) archive
-                continue
-            if len(fl) == 1:
-                single_root = True
-            else:
-                # TODO: handle backslashes?
-                single_root = len({f.split('/', 1)[0] for f in fl}) <= 1
-
-            extract_root = root if single_root else safepath(os.path.join(root, splitext[0]))
-
-            for f in fl:
-                dest = os.path.join(
-                    extract_root,
-                    truncate_utf8_filename(f, int(filename_length)) if filename_length else f
-                )
-
-                if verbose:
-                    print(f'extracting {os.path.join(root, name)}:{f} -> {dest}')
-
-                if os.path.exists(dest):
-                    choice = conflict
-                    if choice is None:
-                        print(f'{dest} already exists.')
-                    while choice not in ['o', 'r', 's']:
-                        choice = input('[S]kip, [o]verwrite, or [r]ename: ')
-                        if not choice:
-                            choice = 's'
-                    if choice == 's':
-                        continue
-                    elif choice == 'r':
-                        dest = safepath(dest)
-
-                try:
-                    os.makedirs(os.path.split(dest)[0])
-                except FileExistsError:
-                    pass
-
-                fext = os.path.splitext(f)[1]
-                dj = fext in dejizz_ext
-                if dj and not no_dejizz:
-                    djfilter = DejizzFilter()
-                extractor.extract(f, dest, write_hook=djfilter.dejizz if dj else None)
-                if dj and verbose and djfilter.detected_encoding != 'utf-8':
-                    print(f'converted from {djfilter.detected_encoding} to UTF-8: {f}')
-
-            if delete_archives:
-                del_arch = os.path.join(root, name)
-                if verbose:
-                    print(f'deleting {del_arch}')
-                os.unlink(del_arch)
+    options = ExtractOptions(dejizz_ext, no_dejizz, delete_archives, verbose, conflict, filename_length)
+    archives = [(root, name) for root, name in filelist(source) if os.path.splitext(name)[1].lower() in EXTRACTORS]
+
+    # asking what to do about existing files needs stdin, so only go parallel if we never have to ask
+    if conflict is None or len(archives) < 2:
+        for root, name in archives:
+            _extract_one(root, name, options)
+        return
+
+    with concurrent.futures.ProcessPoolExecutor() as ex:
+        list(ex.map(_extract_one,
+                    [root for root, _ in archives],
+                    [name for _, name in archives],
+                    [options] * len(archives),
+                    chunksize=4))